@@ -499,7 +499,9 @@ class SimpleAuthHandler(object):
       expected: String, existing token. Normally stored in a user session.
       actual: String, token provided via 'state' param.
     """
-    if expected != actual:
+    # for tokens of equal length the comparison time doesn't leak
+    # how much of the token matched
+    if not security.compare_hashes(expected or '', actual or ''):
       return False
 
     try:
@@ -10,12 +10,16 @@ try:
 except ImportError:
   import simplejson as json
 
+import webapp2
 from webapp2 import WSGIApplication, Route, RequestHandler
 from httplib2 import Response
 
 import simpleauth as sa
 from simpleauth import SimpleAuthHandler
 
+_json_dumps = json.dumps
+_json_loads = json.loads
+
 #
 # test subjects
 #
@@ -32,27 +36,35 @@ class OAuth1ClientMock(object):
 class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
   SESSION_MOCK = {}
 
+  _CONSUMER_INFO = {
+    'dummy_oauth1': ('cons_key', 'cons_secret'),
+    'dummy_oauth2': ('cl_id', 'cl_secret', 'a_scope'),
+  }
+
+  # copies, so that SimpleAuthHandler's own dicts stay intact
+  PROVIDERS = dict(SimpleAuthHandler.PROVIDERS)
+  PROVIDERS.update({
+    'dummy_oauth1': ('oauth1', {
+      'request': 'https://dummy/oauth1_rtoken',
+      'auth'  : 'https://dummy/oauth1_auth?{0}'
+    }, 'https://dummy/oauth1_atoken'),
+    'dummy_oauth2': ('oauth2', 'https://dummy/oauth2?{0}', 
+                               'https://dummy/oauth2_token'),
+  })
+
+  TOKEN_RESPONSE_PARSERS = dict(SimpleAuthHandler.TOKEN_RESPONSE_PARSERS)
+  TOKEN_RESPONSE_PARSERS.update({
+    'dummy_oauth1': '_json_parser',
+    'dummy_oauth2': '_json_parser'
+  })
+
   def __init__(self, *args, **kwargs):
     super(DummyAuthHandler, self).__init__(*args, **kwargs)
-    self.PROVIDERS.update({
-      'dummy_oauth1': ('oauth1', {
-        'request': 'https://dummy/oauth1_rtoken',
-        'auth'  : 'https://dummy/oauth1_auth?{0}'
-      }, 'https://dummy/oauth1_atoken'),
-      'dummy_oauth2': ('oauth2', 'https://dummy/oauth2?{0}', 
-                                 'https://dummy/oauth2_token'),
-    })
-    
-    self.TOKEN_RESPONSE_PARSERS.update({
-      'dummy_oauth1': '_json_parser',
-      'dummy_oauth2': '_json_parser'
-    })
-
     self.session = self.SESSION_MOCK.copy()
     
   def dispatch(self):
     RequestHandler.dispatch(self)
-    self.response.headers['SessionMock'] = json.dumps(self.session)
+    self.response.headers['SessionMock'] = _json_dumps(self.session)
 
   def _on_signin(self, user_data, auth_info, provider):
     self.redirect('/logged_in?provider=%s' % provider)
@@ -61,10 +73,7 @@ class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
     return '/auth/%s/callback' % provider
     
   def _get_consumer_info_for(self, provider):
-    return {
-      'dummy_oauth1': ('cons_key', 'cons_secret'),
-      'dummy_oauth2': ('cl_id', 'cl_secret', 'a_scope'),
-    }.get(provider, (None, None))
+    return self._CONSUMER_INFO.get(provider, (None, None))
 
   # Mocks
 
@@ -90,6 +99,22 @@ class DummyAuthHandler(RequestHandler, SimpleAuthHandler):
 #
 
 class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    super(SimpleAuthHandlerTestCase, cls).setUpClass()
+    # handler instance for some of the tests. It's built before setUp()
+    # resets SESSION_MOCK, so its session is the class default {}, not per-test
+    # state: tests using self.handler must not rely on self.handler.session.
+    cls.handler = DummyAuthHandler()
+
+    # Dummy app to run the tests against
+    routes = [
+      Route('/auth/<provider>', handler=DummyAuthHandler, 
+        handler_method='_simple_auth'),
+      Route('/auth/<provider>/callback', handler=DummyAuthHandler, 
+        handler_method='_auth_callback') ]
+    cls.app = WSGIApplication(routes, debug=True)
+
   def setUp(self):
     super(SimpleAuthHandlerTestCase, self).setUp()
     # set back to default value
@@ -101,16 +126,23 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       }
     }
 
-    # handler instance for some of the tests
-    self.handler = DummyAuthHandler()
-
-    # Dummy app to run the tests against
-    routes = [
-      Route('/auth/<provider>', handler=DummyAuthHandler, 
-        handler_method='_simple_auth'),
-      Route('/auth/<provider>/callback', handler=DummyAuthHandler, 
-        handler_method='_auth_callback') ]
-    self.app = WSGIApplication(routes, debug=True)
+  def _invoke(self, provider, query=''):
+    """Runs DummyAuthHandler._simple_auth() directly, bypassing the app's
+    routing and dispatch. Returns handler's response.
+
+    The /auth/<provider> route itself is only exercised by
+    test_csrf_oauth2_init and the 500 check in test_not_supported_provider,
+    so keep at least those on self.app.get_response().
+    """
+    req = webapp2.Request.blank('/auth/%s?%s' % (provider, query))
+    self.app.set_globals(app=self.app, request=req)
+
+    try:
+      h = DummyAuthHandler(req, webapp2.Response())
+      h._simple_auth(provider)
+      return h.response
+    finally:
+      self.app.clear_globals()
     
   def test_providers_dict(self):
     for p in ('google', 'twitter', 'linkedin', 'openid', 
@@ -134,10 +166,10 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
 
     resp = self.app.get_response('/auth/xxx')
     self.assertEqual(resp.status_int, 500)
-    self.assertRegexpMatches(resp.body, 'UnknownAuthMethodError')
+    self.assertIn('UnknownAuthMethodError', resp.body)
 
   def test_openid_init(self):
-    resp = self.app.get_response('/auth/openid?identity_url=some.oid.provider.com')
+    resp = self._invoke('openid', 'identity_url=some.oid.provider.com')
     self.assertEqual(resp.status_int, 302)
     self.assertEqual(resp.headers['Location'], 
       'https://www.google.com/accounts/Login?'
@@ -165,10 +197,10 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     self.expectErrors()
     resp = self.app.get_response('/auth/openid/callback')
     self.assertEqual(resp.status_int, 500)
-    self.assertRegexpMatches(resp.body, 'InvalidOpenIDUserError')
+    self.assertIn('InvalidOpenIDUserError', resp.body)
 
   def test_oauth1_init(self):
-    resp = self.app.get_response('/auth/dummy_oauth1')
+    resp = self._invoke('dummy_oauth1')
     
     self.assertEqual(resp.status_int, 302)
     self.assertEqual(resp.headers['Location'], 
@@ -187,7 +219,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     self.expectErrors()
     resp = self.app.get_response('/auth/dummy_oauth1/callback')
     self.assertEqual(resp.status_int, 500)
-    self.assertRegexpMatches(resp.body, 'No OAuth verifier was provided')
+    self.assertIn('No OAuth verifier was provided', resp.body)
       
   def test_query_string_parser(self):
     parsed = self.handler._query_string_parser('param1=val1&param2=val2')
@@ -213,7 +245,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       'response_type=code&'
       'client_id=cl_id')
 
-    session = json.loads(resp.headers['SessionMock'])
+    session = _json_loads(resp.headers['SessionMock'])
     session_token = session.get(DummyAuthHandler.OAUTH2_CSRF_SESSION_PARAM, '')
     self.assertEqual(session_token, 'valid-csrf-token')
 
@@ -225,7 +257,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       DummyAuthHandler.OAUTH2_CSRF_SESSION_PARAM: csrf_token
     }
 
-    fetch_resp = json.dumps({
+    fetch_resp = _json_dumps({
       "access_token":"1/fFAGRNJru1FTz70BzhT3Zg",
       "expires_in": 3600,
       "token_type":"Bearer"
@@ -241,7 +273,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       'http://localhost/logged_in?provider=dummy_oauth2')
 
     # token should be removed after during the authorization step
-    session = json.loads(resp.headers['SessionMock'])
+    session = _json_loads(resp.headers['SessionMock'])
     self.assertFalse(DummyAuthHandler.OAUTH2_CSRF_SESSION_PARAM in session)
 
   def test_csrf_oauth2_failure(self):
@@ -254,7 +286,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       'code=auth-code&state=%s' % token)
 
     self.assertEqual(resp.status_int, 500)
-    self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
+    self.assertIn('InvalidCSRFTokenError', resp.body)
 
   def test_csrf_oauth2_tokens_dont_match(self):
     self.expectErrors()
@@ -271,7 +303,7 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
       'code=auth-code&state=%s' % token2)
 
     self.assertEqual(resp.status_int, 500)
-    self.assertRegexpMatches(resp.body, 'InvalidCSRFTokenError')
+    self.assertIn('InvalidCSRFTokenError', resp.body)
 
   def test_csrf_token_generation(self):
     h = SimpleAuthHandler()
@@ -295,6 +327,9 @@ class SimpleAuthHandlerTestCase(TestMixin, unittest.TestCase):
     token2 = h._generate_csrf_token()
     self.assertTrue(h._validate_csrf_token(token, token))
     self.assertFalse(h._validate_csrf_token(token, token2))
+    # same length, different content
+    tampered = token[:-1] + ('A' if token[-1] != 'A' else 'B')
+    self.assertFalse(h._validate_csrf_token(token, tampered))
     self.assertFalse(h._validate_csrf_token('', token))
     self.assertFalse(h._validate_csrf_token(token, ''))
     self.assertFalse(h._validate_csrf_token('', ''))